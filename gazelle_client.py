@@ -1,8 +1,20 @@
-import pickle
+import copy
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Tuple
+from urllib.parse import urljoin, urlparse
 
 import requests
-import appdirs
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
 
 __VERSION__ = "1.0.1"
 DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) " \
@@ -10,7 +22,35 @@ DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) " \
                      "Chrome/74.0.3729.169 Safari/537.36"
 
 
+@lru_cache(maxsize=1)
+def _config_dir() -> str:
+    import appdirs
+    return appdirs.user_config_dir("gazelle_api_py", False)
+
+
+class _Retry(Retry):
+    """
+    Retry that caps Retry-After sleeps, so a rate limiting site can't stall a call indefinitely
+    """
+
+    MAX_RETRY_AFTER = 10
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.MAX_RETRY_AFTER)
+
+
 class GazelleClient:
+    """
+    Client for a Gazelle site's ajax API
+
+    All requests reuse one pooled session, call close() or use the client
+    as a context manager to release its connections when done with it.
+    """
+
+    __slots__ = ("host", "_session", "_ajax_url", "_login_url", "_cache")
 
     def __init__(self,
                  host: str,
@@ -19,83 +59,208 @@ class GazelleClient:
                  *,
                  user_agent: str = DEFAULT_USER_AGENT):
         self.host: str = host
-        self._user_agent = user_agent
+        self._ajax_url = f"{host.rstrip('/')}/ajax.php"
+        self._login_url = f"{host.rstrip('/')}/login.php"
+        self._cache: Dict[tuple, Tuple[float, dict]] = {}
 
         self._session = requests.Session()
+        self._session.headers["User-Agent"] = user_agent
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=_Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=frozenset(["GET", "HEAD"]),
+                # Hand the last response back so raise_for_status() raises HTTPError as before
+                raise_on_status=False
+            )
+        )
+        netloc = host.split("://", 1)[-1]
+        self._session.mount(f"http://{netloc}", adapter)
+        self._session.mount(f"https://{netloc}", adapter)
+
+        # Logging in always makes a request to the host, so the first API call
+        # reuses that keep-alive connection instead of paying DNS and TLS setup
         self._login(username, password)
 
+    def __enter__(self) -> "GazelleClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Closes the session and its pooled connections
+        """
+        self._session.close()
+
     def _login(self, username: str = None, password: str = None, twofa: str = ""):
-        config_dir = appdirs.user_config_dir("gazelle_api_py", False)
-        if not os.path.exists(config_dir):
-            os.mkdir(config_dir)
+        config_dir = _config_dir()
+        os.makedirs(config_dir, exist_ok=True)
 
         # Load cookies if already saved to file
+        # Check if cookies are valid else relogin and store cookies again
         config_file = os.path.join(config_dir, "cookies")
-        if os.path.exists(config_file):
-            with open(config_file, "rb") as f:
-                self._session.cookies.update(pickle.load(f))
-
-            # Check if cookies are valid else relogin and store cookies again
+        saved_cookies = None
+        try:
+            with open(config_file, "r") as f:
+                saved_cookies = f.read()
+            for cookie in json.loads(saved_cookies):
+                self._session.cookies.set(cookie["name"], cookie["value"],
+                                          domain=cookie["domain"], path=cookie["path"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError, KeyError):
+            # Unreadable file or one from an older pickle or flat dict based version
+            self._session.cookies.clear()
+        else:
+            # Only the redirect matters, so skip fetching and decoding the index body,
+            # request errors are raised as is since logging in again would not help
             try:
-                self.index()
-                return
+                response = self._request("HEAD", self._ajax_url, params={"action": "index"})
             except ValueError:
                 pass
+            else:
+                response.raise_for_status()
+                return
 
         if username is not None and password is not None:
-            response = self._session.post(
-                f"{self.host}/login.php",
-                data={
-                    "username": username,
-                    "password": password,
-                    "twofa": twofa,
-                    "login": "Log+in"
-                },
-                headers={
-                    "User-Agent": self._user_agent
-                }
-            )
-
-            if "login.php" in response.url:
+            # Drop stale cookies so the new session cookie doesn't get sent alongside them
+            self._session.cookies.clear()
+            data = {
+                "username": username,
+                "password": password,
+                "twofa": twofa,
+                "login": "Log+in"
+            }
+            response = self._session.post(self._login_url, data=data, allow_redirects=False)
+
+            # A 301/302 to login.php on another scheme or host would turn into a GET and lose the form,
+            # so post it there once. A failed login redirects to the same origin and isn't resent
+            if response.is_redirect:
+                location = urljoin(response.url, response.headers["Location"])
+                if self._is_login_url(location) and urlparse(location)[:2] != urlparse(response.url)[:2]:
+                    response = self._session.post(location, data=data, allow_redirects=False)
+                if response.is_redirect:
+                    response = self._session.get(urljoin(response.url, response.headers["Location"]))
+
+            if self._is_login_url(response.url):
                 raise ValueError("Invalid username/password, failed to login")
 
-            with open(config_file, "wb") as f:
-                pickle.dump(self._session.cookies, f)
+            # Only rewrite the file if cookies changed, through a temp file so a crash can't leave it half written
+            # Keep domain and path so cookies stay scoped to the site and replace each other on relogin
+            cookies = json.dumps([
+                {"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path}
+                for cookie in self._session.cookies
+            ], sort_keys=True)
+            if cookies != saved_cookies:
+                temp_file = f"{config_file}.tmp"
+                with open(temp_file, "w") as f:
+                    f.write(cookies)
+                os.replace(temp_file, config_file)
         else:
             raise ValueError("Neither session or username and password was not provided.")
 
-    def get(self, action: str, **kwargs) -> dict:
-        special = kwargs.pop("special", {})
+    @staticmethod
+    def _is_login_url(url: str) -> bool:
+        # Compare the path only, the site may have redirected to another scheme or host
+        return urlparse(url).path.endswith("/login.php")
 
-        params = {
-            "action": action,
-            **kwargs
-        }
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Makes a request, following redirects by hand so one to login.php is caught
+        without requesting it, others such as http to https are followed like requests would
 
-        params.update(special)
+        Args:
+            method (str): HTTP method to use
+            url (str): URL to request
 
-        response = self._session.get(
-            f"{self.host}/ajax.php",
-            params=params,
-            headers={
-                "User-Agent": self._user_agent
-            }
-        )
+        Returns:
+            Response of the last request in the redirect chain
+        """
+        response = self._session.request(method, url, allow_redirects=False, **kwargs)
+
+        redirects = 0
+        while response.is_redirect:
+            location = urljoin(response.url, response.headers["Location"])
+            if self._is_login_url(location):
+                raise ValueError("Unable to make request, invalid session")
+
+            redirects += 1
+            if redirects > self._session.max_redirects:
+                raise requests.TooManyRedirects(f"Exceeded {self._session.max_redirects} redirects.",
+                                                response=response)
+            response = self._session.request(method, location, allow_redirects=False)
 
-        if "login.php" in response.url:
-            raise ValueError("Unable to make request, invalid session")
+        return response
 
+    def get(self, action: str, **kwargs) -> dict:
+        special = kwargs.pop("special", None)
+        params = {"action": action, **kwargs, **(special or {})}
+
+        response = self._request("GET", self._ajax_url, params=params)
         response.raise_for_status()
-        return response.json()
+        return _loads(response.content)
 
-    def index(self, **kwargs) -> dict:
+    def _cached_get(self, action: str, ttl: float, **kwargs) -> dict:
+        """
+        Calls get(), reusing a previous response for the same params while it is newer than ttl,
+        callers get their own copy so changing it doesn't affect the cache
+
+        Args:
+            action (str): ajax.php action to request
+            ttl (float): Seconds a cached response stays valid, 0 to always fetch
+
+        Returns:
+            Dict containing the response data
+        """
+        if ttl <= 0:
+            return self.get(action, **kwargs)
+
+        try:
+            key = (action, frozenset(kwargs.items()))
+            cached = self._cache.get(key)
+        except TypeError:
+            # Unhashable params such as special can't be cached
+            return self.get(action, **kwargs)
+
+        now = time.monotonic()
+        if cached is not None and now - cached[0] < ttl:
+            return copy.deepcopy(cached[1])
+
+        data = self.get(action, **kwargs)
+        self._cache[key] = (now, copy.deepcopy(data))
+        return data
+
+    def batch(self, calls: List[Tuple[str, dict]], max_workers: int = 8) -> List[dict]:
+        """
+        Makes multiple API calls concurrently over the shared session
+
+        Args:
+            calls (list): List of (action, kwargs) tuples, each passed to get()
+            max_workers (int): Amount of requests to run at once
+
+        Returns:
+            List of responses in the same order as calls
+        """
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = [executor.submit(self.get, action, **kwargs) for action, kwargs in calls]
+            return [future.result() for future in futures]
+
+    def index(self, *, ttl: float = 0, **kwargs) -> dict:
         """
         Gets index page of the API
 
+        Args:
+            ttl (float): Seconds to reuse a cached response for, by default 0 which always fetches
+
         Returns:
             Dict containing basic index data for the current logged in user
         """
-        return self.get("index", **kwargs)
+        return self._cached_get("index", ttl, **kwargs)
 
     def user(self, user_id: int, **kwargs) -> dict:
         """
@@ -107,7 +272,7 @@ class GazelleClient:
         Returns:
             Dict containing user information if exists
         """
-        return self.get("user", id=str(user_id), **kwargs)
+        return self.get("user", id=user_id, **kwargs)
 
     def inbox(self, page: int = 1, inbox_type: str = "inbox", **kwargs) -> dict:
         """
@@ -125,7 +290,7 @@ class GazelleClient:
         Returns:
             Dict containing user inbox messages
         """
-        return self.get("inbox", page=str(page), type=inbox_type, **kwargs)
+        return self.get("inbox", page=page, type=inbox_type, **kwargs)
 
     def conversation(self, conversation_id: int, **kwargs) -> dict:
         """
@@ -137,7 +302,7 @@ class GazelleClient:
         Returns:
 
         """
-        return self.get("inbox", type="viewconv", id=str(conversation_id), **kwargs)
+        return self.get("inbox", type="viewconv", id=conversation_id, **kwargs)
 
     def top10(self, top_type: str = "torrents", limit: int = 10, **kwargs) -> dict:
         """
@@ -150,7 +315,7 @@ class GazelleClient:
         Returns:
             Dict containing top information for specified type and amount
         """
-        return self.get("top10", type=top_type, limit=str(limit), **kwargs)
+        return self.get("top10", type=top_type, limit=limit, **kwargs)
 
     def user_search(self, search: str, page: int = 1, **kwargs) -> dict:
         """
@@ -163,7 +328,7 @@ class GazelleClient:
         Returns:
             Dict of found users from search term
         """
-        return self.get("usersearch", search=search, page=str(page), **kwargs)
+        return self.get("usersearch", search=search, page=page, **kwargs)
 
     def requests(self, page: int = 1, **kwargs) -> dict:
         """
@@ -181,7 +346,7 @@ class GazelleClient:
         Returns:
             Dict containing found requests based on search results
         """
-        return self.get("requests", page=str(page), **kwargs)
+        return self.get("requests", page=page, **kwargs)
 
     def torrents(self, page: int = 1, **kwargs) -> dict:
         """
@@ -196,7 +361,7 @@ class GazelleClient:
         Returns:
             Dict containing torrent information found
         """
-        return self.get("browse", page=str(page), **kwargs)
+        return self.get("browse", page=page, **kwargs)
 
     def bookmarks(self, bookmark_type: str = "torrents", **kwargs) -> dict:
         """
@@ -222,14 +387,17 @@ class GazelleClient:
         """
         return self.get("subscriptions", showunread=showunread, **kwargs)
 
-    def forums(self, **kwargs) -> dict:
+    def forums(self, *, ttl: float = 0, **kwargs) -> dict:
         """
         Get forums
 
+        Args:
+            ttl (float): Seconds to reuse a cached response for, by default 0 which always fetches
+
         Returns:
             Forum data from specified type
         """
-        return self.get("forum", type="main", **kwargs)
+        return self._cached_get("forum", ttl, type="main", **kwargs)
 
     def forum_view(self, forum_id: int, page: int = 1, **kwargs) -> dict:
         """
@@ -242,7 +410,7 @@ class GazelleClient:
         Returns:
             Dict containing forum data to view
         """
-        return self.get("forum", type="viewforum", forumid=str(forum_id), page=str(page), **kwargs)
+        return self.get("forum", type="viewforum", forumid=forum_id, page=page, **kwargs)
 
     def thread_view(self, thread_id: int, page: int = 1, **kwargs) -> dict:
         """
@@ -259,7 +427,7 @@ class GazelleClient:
         Returns:
             Dict containing thread data
         """
-        return self.get("forum", type="viewthread", threadid=str(thread_id), page=str(page), **kwargs)
+        return self.get("forum", type="viewthread", threadid=thread_id, page=page, **kwargs)
 
     def artist(self, **kwargs) -> dict:
         """
@@ -312,7 +480,7 @@ class GazelleClient:
         Returns:
             Dict containing the data of a request
         """
-        return self.get("request", id=str(request_id), page=str(page), **kwargs)
+        return self.get("request", id=request_id, page=page, **kwargs)
 
     def collages(self, collage_id: int, **kwargs) -> dict:
         """
@@ -324,7 +492,7 @@ class GazelleClient:
         Returns:
             Dict containing collage data
         """
-        return self.get("collage", id=str(collage_id), **kwargs)
+        return self.get("collage", id=collage_id, **kwargs)
 
     def notifications(self, page: int = 1, **kwargs) -> dict:
         """
@@ -336,7 +504,7 @@ class GazelleClient:
         Returns:
             Dict containing notification data for a user
         """
-        return self.get("notifications", page=str(page), **kwargs)
+        return self.get("notifications", page=page, **kwargs)
 
     def similar_artists(self, artist_id: int, limit: int, **kwargs):
         """
@@ -349,13 +517,16 @@ class GazelleClient:
         Returns:
             Dict containing similar artists
         """
-        return self.get("similar_artists", id=str(artist_id), limit=str(limit), **kwargs)
+        return self.get("similar_artists", id=artist_id, limit=limit, **kwargs)
 
-    def announcements(self, **kwargs) -> dict:
+    def announcements(self, *, ttl: float = 0, **kwargs) -> dict:
         """
         Get announcements for the site
 
+        Args:
+            ttl (float): Seconds to reuse a cached response for, by default 0 which always fetches
+
         Returns:
             Dict containing announcement data
         """
-        return self.get("announcements", **kwargs)
+        return self._cached_get("announcements", ttl, **kwargs)
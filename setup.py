@@ -3,7 +3,9 @@ from setuptools import setup
 # Requirements
 requirements = [
     "requests",
-    "appdirs"
+    "urllib3>=1.26",
+    "appdirs",
+    "brotli"
 ]
 
 
@@ -17,6 +19,9 @@ setup(
     py_modules=["gazelle_client"],
     python_requires=">=3.7",
     install_requires=requirements,
+    extras_require={
+        "fast": ["orjson"]
+    },
     classifiers=[
         "Intended Audience :: Developers",
         "Topic :: Software Development :: Libraries",